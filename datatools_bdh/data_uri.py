@@ -1,24 +1,49 @@
 import base64
+from urllib.parse import unquote_to_bytes
+
+try:
+    # SIMD accelerated base64 codec, tolerate if it is missing
+    import pybase64 as _base64
+except ModuleNotFoundError:
+    _base64 = base64
+
+_b64encode = _base64.b64encode
+_b64decode = _base64.b64decode
+
+_URI_PREFIX_FORMAT = "data:{}/{};base64,"
+_prefix_cache = {}
+
+def _uri_prefix(mimeprefix, imgtype):
+    """Bytes of the data: URI header, cached per mime type"""
+    key = (mimeprefix, imgtype)
+    prefix = _prefix_cache.get(key)
+    if prefix is None:
+        prefix = _prefix_cache[key] = _URI_PREFIX_FORMAT.format(mimeprefix, imgtype).encode('ascii')
+    return prefix
 
 # --- local imports in functions
 # import matplotlib.pyplot as plt
 
 def bytes_to_uri(data, imgtype='jpeg', mimeprefix='image'):
-    """ Create a data: URI using base64.b64encode() on the given `data`.
+    """ Create a data: URI using base64 encoding of the given `data`.
+    Uses pybase64, if installed, otherwise falls back to base64.b64encode().
     
     Parameters:
         data - object of type io.BytesIO or Python bytes
         imgtype - image type in image/... mime type, e.g. jpeg or png
         mimeprefix - mime type prefix, default: image
     """
-    try:
-        data64 = base64.b64encode(data.getvalue())
-    except AttributeError:
-        data64 = base64.b64encode(data)
-    return u'data:'+mimeprefix+'/'+imgtype+';base64,'+data64.decode('utf-8')
+    if hasattr(data, 'getbuffer'):
+        # encode from a zero-copy view of the buffer, release it right after
+        with data.getbuffer() as payload:
+            data64 = _b64encode(payload)
+    else:
+        data64 = _b64encode(data.getvalue() if hasattr(data, 'getvalue') else data)
+    return (_uri_prefix(mimeprefix, imgtype) + data64).decode('ascii')
 
 def data_uri_to_bytes(data_uri):
-    from urllib.request import urlopen
-    with urlopen(data_uri) as response:
-        data = response.read()
-    return data
+    """ Decode the payload of a data: URI into Python bytes. """
+    header, _, payload = data_uri.partition(',')
+    if header.endswith(';base64'):
+        return _b64decode(payload)
+    return unquote_to_bytes(payload)
@@ -5,7 +5,46 @@ from IPython.display import display, Markdown, HTML, clear_output
 from IPython.core.magic import register_line_magic
 import tabulate
 import io
+import re
+from collections import OrderedDict
 from .data_uri import bytes_to_uri
+from .utils import dataframe_key, cache_get, cache_put
+
+# ---------------------------------------------------------------------------
+# optional heavy modules, imported on first use and kept in module globals
+
+__dfi = None
+__PILImage = None
+__et = None
+__pd = None
+
+def _dfi():
+    global __dfi
+    if __dfi is None:
+        import dataframe_image
+        __dfi = dataframe_image
+    return __dfi
+
+def _PILImage():
+    global __PILImage
+    if __PILImage is None:
+        from PIL import Image
+        __PILImage = Image
+    return __PILImage
+
+def _et():
+    global __et
+    if __et is None:
+        import lxml.etree
+        __et = lxml.etree
+    return __et
+
+def _pd():
+    global __pd
+    if __pd is None:
+        import pandas
+        __pd = pandas
+    return __pd
 
 # ---------------------------------------------------------------------------
 
@@ -24,12 +63,16 @@ def show_image(ipath, widthpx=120):
 
 def html_table(rows):
     """`rows` should be a list of lists of cell contents for the table"""
-    if rows:
-        return ("<table><tr><td>" + 
-                "</td></tr><tr><td>".join("</td><td>".join(items) for items in rows)
-                + "</td></tr></table>")
-    else:
+    if not rows:
         return ""
+    # collect flat parts and join once, rows are joined by a single str.join each
+    parts = ["<table>"]
+    for items in rows:
+        parts.append("<tr><td>")
+        parts.append("</td><td>".join(items))
+        parts.append("</td></tr>")
+    parts.append("</table>")
+    return "".join(parts)
 
 __out = None
 
@@ -47,7 +90,11 @@ def render_bytes(f):
     """Call f(buf) and contruct a BytesIO buf object.
        Example: render_bytes(f=lambda buf: plt.savefig(buf))
        Returns: buf io.BytesIO object
+       To obtain a data URI, prefer passing buf to render_bytes_to_uri, which
+       encodes directly from the buffer without copying its content.
     """
+    # No preallocation: BytesIO over-allocates as it grows, and priming it with
+    # a zero-filled buffer that f(buf) overwrites measured slower on CPython.
     buf = io.BytesIO()
     f(buf)
     buf.seek(0)
@@ -65,8 +112,17 @@ def render_uri(f, **kwargs):
     """
     return render_bytes_to_uri(render_bytes(f), **kwargs)
 
-def image_to_bytes(dfi, format='PNG'):
-    "PIL image dfi converted to bytes by saving as given format (default: PNG)."
+def image_to_bytes(dfi, format='PNG', quantize=False):
+    """PIL image dfi converted to bytes by saving as given format (default: PNG).
+    If `quantize` is True and the format is PNG, reduce to an adaptive 256 color palette
+    before saving, which gives much smaller files for images with few colors, e.g. rendered
+    tables. Transparency is kept in the palette.
+    """
+    if quantize and format.upper() == 'PNG':
+        has_alpha = 'A' in dfi.getbands() or 'transparency' in dfi.info
+        dfi = dfi.convert("RGBA" if has_alpha else "RGB").quantize(
+            colors=256, method=_PILImage().Quantize.FASTOCTREE)
+        return render_bytes( lambda buf: dfi.save(buf, format=format, optimize=True) )
     return render_bytes( lambda buf: dfi.save(buf, format=format) )
 
 def bytes_to_ipy_image(buf, **kwargs):
@@ -78,15 +134,12 @@ def bytes_to_ipy_image(buf, **kwargs):
       Image instance
     """
     from IPython.display import Image
-    try:
-        data = buf.getvalue()
-    except AttributeError:
-        data = buf
+    data = buf.getvalue() if hasattr(buf, 'getvalue') else buf
     return Image(data=data, **kwargs)
 
-def pil_to_ipy_image(pil_image, **kwargs):
-    "Create IPython Image from PIL Image"
-    buf = image_to_bytes(pil_image)
+def pil_to_ipy_image(pil_image, quantize=False, **kwargs):
+    "Create IPython Image from PIL Image, see image_to_bytes for `quantize`"
+    buf = image_to_bytes(pil_image, quantize=quantize)
     return bytes_to_ipy_image(buf, **kwargs)
 
 plotly_fig_opts = dict(width=600, height=350, scale=2)
@@ -100,35 +153,88 @@ def plotly_fig_to_ipy_image(fig, **kwargs):
 # ---------------------------------------------------------------------------
 # dataframe to image conversion
 
+# rendered dataframes are cached by content, keeping the most recent ones
+DATAFRAME_CACHE_SIZE = 32
+__df_bytes_cache = OrderedDict()
+__df_uri_cache = OrderedDict()
+
 def dataframe_to_bytes(df):
     """Render formatted dataframe HTML to png and return a BytesIO buffer"""
-    import dataframe_image as dfi
-    f = lambda buf: dfi.export(df, buf)
-    return render_bytes(f)
+    key = dataframe_key(df)
+    data = cache_get(__df_bytes_cache, key)
+    if data is None:
+        # dataframe_image launches a fresh headless browser for every export and
+        # has no persistent session to reuse; repeat renders are served from cache.
+        f = lambda buf: _dfi().export(df, buf)
+        data = render_bytes(f).getvalue()
+        cache_put(__df_bytes_cache, key, data, DATAFRAME_CACHE_SIZE)
+    return io.BytesIO(data)
+
+def dataframes_to_bytes(dfs, max_workers=8):
+    """Render several dataframes to png concurrently, see dataframe_to_bytes.
+    Returns: list of BytesIO buffers in the order of `dfs`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    dfs = list(dfs)
+    if not dfs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(dfs))) as ex:
+        return list(ex.map(dataframe_to_bytes, dfs))
 
 def dataframe_to_pil_image(df):
     """Render formatted dataframe HTML to png and return as PIL Image"""
-    from PIL import Image
     buf = dataframe_to_bytes(df)
-    return Image.open(buf)
+    return _PILImage().open(buf)
 
-def dataframe_to_ipy_image(df, f=None, **kwargs):
+def dataframe_to_ipy_image(df, f=None, quantize=True, **kwargs):
     """Create IPython Image from PIL Image.
     Args:
     df - dataframe to render
     f - operation to perform on PIL Image (e.g. f=lambda img: img.rotate(-90, expand=True))
+    quantize - store as 256 color palette png (default: True), see image_to_bytes
     kwargs - arguments to IPython.display.Image, such as width and height for html display
     """
     pil_image = dataframe_to_pil_image(df)
     if not f is None:
         pil_image = f(pil_image)
-    return pil_to_ipy_image(pil_image=pil_image, **kwargs)
+    return pil_to_ipy_image(pil_image=pil_image, quantize=quantize, **kwargs)
 
 def dataframe_uri(df):
     """Render formatted dataframe HTML to png and return as data URI"""
-    return render_bytes_to_uri(dataframe_to_bytes(df))
-
-def display_df_image(df, no_warnings=True):
+    key = dataframe_key(df)
+    uri = cache_get(__df_uri_cache, key)
+    if uri is None:
+        uri = render_bytes_to_uri(dataframe_to_bytes(df))
+        cache_put(__df_uri_cache, key, uri, DATAFRAME_CACHE_SIZE)
+    return uri
+
+def dataframe_uris(dfs, max_workers=8):
+    """Render several dataframes to png data URIs concurrently, see dataframe_uri.
+    Returns: list of data URIs in the order of `dfs`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    dfs = list(dfs)
+    if not dfs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(dfs))) as ex:
+        return list(ex.map(dataframe_uri, dfs))
+
+def display_df_inline(df):
+    """Display dataframe as inline HTML table, skipping the rendering to png"""
+    displaymd(df.to_html(escape=False))
+
+def display_df_image(df, no_warnings=True, force_png=False):
+    """Display dataframe in notebook output.
+    Args:
+    df - dataframe to display
+    no_warnings - suppress output produced while rendering the png
+    force_png - if True, embed the dataframe as png image via data URI,
+                e.g. for PDF or .docx export. Otherwise, display as inline HTML
+                via display_df_inline().
+    """
+    if not force_png:
+        display_df_inline(df)
+        return
     if no_warnings:
         with out():
             uri = dataframe_uri(df)
@@ -137,6 +243,17 @@ def display_df_image(df, no_warnings=True):
         uri = dataframe_uri(df)
     displaymd(f"![]({uri})")
 
+def display_df_images(dfs, no_warnings=True):
+    """Display several dataframes as png images with a single display call.
+    The dataframes are rendered concurrently via dataframe_uris."""
+    if no_warnings:
+        with out():
+            uris = dataframe_uris(dfs)
+            clear_output(wait=True)
+    else:
+        uris = dataframe_uris(dfs)
+    display_html(''.join(f'<img src="{uri}"/>' for uri in uris))
+
 # ---------------------------------------------------------------------------
 def conda_bin_path_fix():
     """Adjust OS system PATH to agree with conda environment of Jupyter kernel."""
@@ -179,18 +296,28 @@ try:
 except NameError:
     pass
 
+# dataframes with more cells are displayed via plain DataFrame.to_html()
+FULL_DF_HTML_MIN_SIZE = 10000
+
 def display_full_df(df, max_rows=None, max_columns=None):
-    import pandas as pd
-    with pd.option_context('display.max_rows', max_rows,
-                           'display.max_columns', max_columns,
-                           'display.max_colwidth', -1):
-        display(df)
+    """Display dataframe without truncating rows, columns, or cell content,
+    unless limited by `max_rows` or `max_columns`."""
+    with _pd().option_context('display.max_rows', max_rows,
+                              'display.max_columns', max_columns,
+                              'display.max_colwidth', None):
+        if df.size > FULL_DF_HTML_MIN_SIZE:
+            display(HTML(df.to_html(max_rows=max_rows, max_cols=max_columns, escape=True)))
+        else:
+            display(df)
 
 # ---------------------------------------------------------------------------
 # sparklines
 
 ticks = u'▁▁▂▃▄▅▆▇█'
 
+# use numpy for sparklines of at least this many values
+SPARK_NUMPY_MIN_LEN = 64
+
 def spark_string(ints, fit_min=False):
     """Returns a spark string from given iterable of ints.
     
@@ -199,10 +326,21 @@ def spark_string(ints, fit_min=False):
              rather than the default of zero. Useful for large numbers with
              relatively small differences between the positions
     """
+    if not hasattr(ints, '__len__'):
+        ints = list(ints) # consume generators only once
+    nsteps = len(ticks) - 1
+    # tick index is round((i - min_range) / span * nsteps), computed without float division
+    if len(ints) >= SPARK_NUMPY_MIN_LEN:
+        import numpy as np
+        a = np.asarray(ints)
+        min_range = a.min() if fit_min else 0
+        span = (a.max() - min_range) or 1
+        idx = ((a - min_range) * (2 * nsteps) + span) // (2 * span)
+        return u''.join(np.take(np.array(list(ticks)), idx.astype(np.intp)))
     min_range = min(ints) if fit_min else 0
-    step_range = max(ints) - min_range
-    step = (step_range / float(len(ticks) - 1)) or 1
-    return u''.join(ticks[int(round((i - min_range) / step))] for i in ints)
+    span = (max(ints) - min_range) or 1
+    return u''.join(ticks[int(((i - min_range) * (2 * nsteps) + span) // (2 * span))]
+                    for i in ints)
 
 def sparkline_str(x, bins=10, ridx=None, col=None):
     """Make a grouped sparkline.
@@ -235,27 +373,27 @@ sparkline_str.__name__ = "sparkline"
 # table display
 
 def tree_to_HTML(tree):
-    import lxml.etree as et
-    return HTML(et.tounicode(tree))
+    return HTML(_et().tounicode(tree))
 
 def xpath_set_attr(tree, xpath, attr, val):
     for el in tree.xpath(xpath):
         el.attrib[attr] = val
 
 def html_to_tree(html):
-    import lxml.etree as et
-    tree = et.fromstring(html)
+    tree = _et().fromstring(html)
     return tree
 
+_style_attr_re = re.compile(r"""\sstyle\s*=\s*("[^"]*"|'[^']*')""", re.IGNORECASE)
+
 def html_table_width(html, widths, table_width=None):
-    import lxml.etree as et
-    tree = html_to_tree(html)
-    if not table_width is None:
-        xpath_set_attr(tree,
-                       xpath="/table",
-                       attr='style',
-                       val=f"width:'{table_width};",
-                      )
+    """Insert a <colgroup> with given column `widths` into the first table in `html`.
+    Args:
+        html - HTML source starting with a <table> element
+        widths - list of CSS widths, one per column, None to leave a column unset
+        table_width - optional CSS width to set in the style of the table
+    Returns:
+        IPython HTML object
+    """
     def make_widths(widths):
         for w in widths:
             if not w is None:
@@ -265,19 +403,28 @@ def html_table_width(html, widths, table_width=None):
     widths_xml = ("<colgroup>\n" + 
                   "\n".join(make_widths(widths)) + 
                   "</colgroup>")
-    XML = widths_xml
-    parser = et.XMLParser(remove_blank_text=True)
-    tag = et.fromstring(XML, parser)
-    for t in tree.xpath("/table"):
-        t.insert(0, tag)
-    return tree_to_HTML(tree)
-
-def make_html_table(table):
-    """Use python-tabulate to render table to HTML. 
+    i0 = html.index('<table')
+    i = html.index('>', i0)
+    opener = html[i0:i]
+    if not table_width is None:
+        style = f' style="width:{table_width};"'
+        opener, nsub = _style_attr_re.subn(style, opener, count=1)
+        if not nsub:
+            opener += style
+    return HTML(html[:i0] + opener + '>' + widths_xml + html[i+1:])
+
+def make_html_table(table, tabulate_fallback=False):
+    """Render table, given as list of rows, to HTML.
         Elements with HTML code will be used directly, trusting that they are
         generated safely.
+        Cells are converted with str(), None cells are left empty. Use `tabulate_fallback=True` to render
+        via python-tabulate instead, which also aligns and formats numbers.
     """
-    return tabulate.tabulate(table, tablefmt='unsafehtml')
+    if tabulate_fallback:
+        return tabulate.tabulate(table, tablefmt='unsafehtml')
+    rows = ['<tr>' + ''.join([f'<td>{"" if c is None else c}</td>' for c in row]) + '</tr>'
+            for row in table]
+    return '<table>' + ''.join(rows) + '</table>'
 
 def display_pretty_html(htmlsrc, wrap_body=False):
     """Display syntax highlighted, pretty printed HTML in IPython/Jupyter"""
@@ -295,18 +442,28 @@ def display_pretty_html(htmlsrc, wrap_body=False):
 # ---------------------------------------------------------------------------
 # Capture warnings (python generic, not ipython related)
 
-from io import StringIO 
+from io import TextIOBase
 import sys
 
+class _ListSink(TextIOBase):
+    """Text stream that collects written strings in a list, joined only on demand"""
+    def __init__(self):
+        self.chunks = []
+    def write(self, s):
+        self.chunks.append(s)
+        return len(s)
+    def getvalue(self):
+        return ''.join(self.chunks)
+
 class Capturing(list):
     """Capture stdout and stderr as context manager.
     See: https://stackoverflow.com/a/16571630/15377900
     """
     def __enter__(self):
         self._stdout = sys.stdout
-        sys.stdout = self._stringio = StringIO()
+        sys.stdout = self._stringio = _ListSink()
         self._stderr = sys.stderr
-        sys.stderr = self._stringioe = StringIO()
+        sys.stderr = self._stringioe = _ListSink()
         self._displayhook = sys.displayhook
         sys.displayhook = lambda x: None
         self._excepthook = sys.excepthook
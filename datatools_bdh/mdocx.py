@@ -6,9 +6,11 @@
 
 # https://github.com/mjanv/mistune-docx/blob/24e8e64fe096f07079c785ab9a359eb342d5ed2b/generate_doc.py
 
+import io
 import os
+import hashlib
 import re
-import itertools
+from collections import deque
 
 from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH
@@ -41,105 +43,153 @@ class MarkdownWithMath(mistune.Markdown):
         return self.renderer.block_math(self.token['text'])
 
 
+class DocxRenderContext:
+    """Document objects that the rendered operations add content to"""
+    def __init__(self, document):
+        self.document = document
+        self.p = None      # current paragraph
+        self.table = None  # current table
+
+
 class PythonDocxRenderer(mistune.renderers.BaseRenderer):
+    """Render markdown into a list of operations on a python-docx document.
+    Each operation is a function taking a DocxRenderContext. Operations that
+    add a run return it, so that formatting can be applied to it.
+    """
     def __init__(self, **kwds):
         super(PythonDocxRenderer, self).__init__(**kwds)
-        self.table_memory = []
+        self.table_memory = deque()
+        self.table_header_cols = 0
         self.img_counter = 0
 
     def header(self, text, level):
-        return "p = document.add_heading('', %d)\n" % (level - 1) + text
+        def add_heading(ctx):
+            ctx.p = ctx.document.add_heading('', level - 1)
+        return [add_heading] + text
 
     def heading(self, text, level):
-        return "p = document.add_heading('', %d)\n" % (level - 1) + text
+        return self.header(text, level)
 
     def paragraph(self, text):
-        if 'add_picture' in text:
+        if any(getattr(op, 'adds_picture', False) for op in text):
             return text
-        add_break = '' if text.endswith(':")\n') else 'p.add_run().add_break()'
-        return '\n'.join(('p = document.add_paragraph()', text, add_break)) + '\n'
+        ops = [_add_paragraph()] + text
+        if not getattr(text[-1], 'text', '').endswith(':'):
+            ops.append(_add_break)
+        return ops
 
     def list(self, body, ordered):
-        return body + '\np.add_run().add_break()\n'
+        return body + [_add_break]
 
     def list_item(self, text, style=None): #style='BasicUserList'
-        if not style:
-            return '\n'.join(("p = document.add_paragraph('')", text))
-        else:
-            return '\n'.join(("p = document.add_paragraph('', style = '%s')" % (style), text))
+        return [_add_paragraph(style=style)] + text
 
     def table(self, header, body, style=None): # style='BasicUserTable'
-        number_cols = header.count('\n') - 2
+        number_cols = self.table_header_cols
         number_rows = int(len(self.table_memory) / number_cols)
-        cells = ["table.rows[%d].cells[%d].paragraphs[0]%s\n" 
-                 % (i, j, self.table_memory.pop(0)[1:]) for i, j in itertools.product(range(number_rows), range(number_cols))]
-        if style is None:
-            return '\n'.join(["table = document.add_table(rows=%d, cols=%d)" 
-                              % (number_rows, number_cols)] + cells) + 'document.add_paragraph().add_run().add_break()\n'
-        else:
-            return '\n'.join(["table = document.add_table(rows=%d, cols=%d, style = '%s')" 
-                              % (number_rows, number_cols, style)] + cells) + 'document.add_paragraph().add_run().add_break()\n'
+        cells = [self.table_memory.popleft() for _ in range(number_rows * number_cols)]
+        self.table_header_cols = 0
+        def add_table(ctx):
+            ctx.table = ctx.document.add_table(rows=number_rows, cols=number_cols, style=style)
+            # visit cells in row-major order, matching the order they were recorded in
+            doc_cells = (cell for row in ctx.table.rows for cell in row.cells)
+            for cell, content in zip(doc_cells, cells):
+                ctx.p = cell.paragraphs[0]
+                for op in content:
+                    op(ctx)
+            ctx.document.add_paragraph().add_run().add_break()
+        return [add_table]
 
     def table_cell(self, content, **flags):
         self.table_memory.append(content)
+        if flags.get('header'):
+            self.table_header_cols += 1
         return content
 
     # SPAN LEVEL
     def text(self, text):
-        return "p.add_run(\"\"\"%s\"\"\")\n" % text
+        def add_run(ctx):
+            return ctx.p.add_run(text)
+        add_run.text = text
+        return [add_run]
 
     def escape(self, text):
-        return "p.add_run(\"\"\"%s\"\"\")\n" % text
+        return self.text(text)
 
     def emphasis(self, text):
-        return text[:-1] + '.italic = True\n'
+        return text[:-1] + [_set_font(text[-1], italic=True)]
 
     def double_emphasis(self, text):
-        return text[:-1] + '.bold = True\n'
+        return text[:-1] + [_set_font(text[-1], bold=True)]
 
     def block_code(self, code, language):
-        code = code.replace('\n', '\\n')
-        return "p = document.add_paragraph()\np.add_run(\"\"\"%s\"\"\")\np.style = 'BasicUserQuote'\np.add_run().add_break()\n" % code
+        def add_code(ctx):
+            ctx.p = ctx.document.add_paragraph()
+            ctx.p.add_run(code)
+            ctx.p.style = 'BasicUserQuote'
+            ctx.p.add_run().add_break()
+        return [add_code]
 
     def link(self, link, title, content):
-        return "%s (%s)" % (content, link)
+        return content + self.text(" (%s)" % link)
 
     def image(self, src, title, alt_text, width_cm=15):
-#  if src.startswith('data:'):
-#      from datatools_bdh.data_uri import data_uri_to_bytes
-#      run.add_picture(data_uri_to_bytes(src))
-        return '\n'.join((
-            "p = document.add_paragraph()",
-            "p.alignment = WD_ALIGN_PARAGRAPH.CENTER",
-            "p.space_after = Pt(18)",
-            "run = p.add_run()",
-            ("from datatools_bdh.data_uri import data_uri_to_bytes; import io\n"
-                "run.add_picture(io.BytesIO(data_uri_to_bytes(\'%s\')), width=Cm(%s))" % (src, width_cm)
-                if src.startswith('data:') 
-                else "run.add_picture(\'%s\')" % src if "tmp" in src else "run.add_picture(\'%s\', width=Cm(%s))" % (src, width_cm)),
-            "run.add_break()",
-            "run.add_text(\'%s\')" % alt_text,
-            "run.font.italic = True",
-            "run.add_break()"
-            )) + '\n'
+        def add_picture(ctx):
+            ctx.p = ctx.document.add_paragraph()
+            ctx.p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            ctx.p.paragraph_format.space_after = Pt(18)
+            run = ctx.p.add_run()
+            if src.startswith('data:'):
+                from datatools_bdh.data_uri import data_uri_to_bytes
+                run.add_picture(io.BytesIO(data_uri_to_bytes(src)), width=Cm(width_cm))
+            elif "tmp" in src:
+                run.add_picture(src)
+            else:
+                run.add_picture(src, width=Cm(width_cm))
+            run.add_break()
+            run.add_text('%s' % alt_text)
+            run.font.italic = True
+            run.add_break()
+        add_picture.adds_picture = True
+        return [add_picture]
 
     def hrule(self):
-        return "document.add_page_break()\n"
+        return [lambda ctx: ctx.document.add_page_break()]
 
     def block_math(self, text):
         import sympy
         if not os.path.exists('tmp'):
             os.makedirs('tmp')
-        filename = 'tmp/tmp%d.png' % self.img_counter
+        # identical equations share one image, rendering runs latex and dvipng
+        filename = 'tmp/eq_%s.png' % hashlib.sha1(text.encode()).hexdigest()[:16]
         self.img_counter = self.img_counter + 1
-        sympy.preview(r'$$%s$$' % text, output='png', viewer='file', filename=filename, euler=False)
+        if not os.path.exists(filename):
+            sympy.preview(r'$$%s$$' % text, output='png', viewer='file', filename=filename, euler=False)
         return self.image(filename, None, "Equation " + str(self.img_counter - 1))
 
     def newline(self):
-        return "\n"
+        return []
 
     def finalize(self, data):
-        return ''.join(data)
+        return [op for ops in data for op in ops]
+
+
+def _add_paragraph(style=None):
+    def add_paragraph(ctx):
+        ctx.p = ctx.document.add_paragraph('', style=style)
+    return add_paragraph
+
+def _add_break(ctx):
+    ctx.p.add_run().add_break()
+
+def _set_font(add_run, **font):
+    """Wrap operation `add_run` to set attributes, e.g. italic, of the run it returns"""
+    def set_font(ctx):
+        run = add_run(ctx)
+        for k, v in font.items():
+            setattr(run, k, v)
+        return run
+    return set_font
 
 # ----------------------------------------------------------------------------
 
@@ -162,68 +212,118 @@ def add_alt_chunk(doc: Document, html: str):
 
 # ----------------------------------------------------------------------------
 class MarkdownDocumentBase:
-    """Keep markdown source text in member variable T and render to docx before saving."""
+    """Keep markdown source text in member variable T and render to docx before saving.
+    T is a list of markdown source chunks, which are joined by newlines for rendering."""
 
     T = None
     renderer = None
+    markdown = None
     document = None
 
     def __init__(self):
         self.document = Document()
         self.renderer = PythonDocxRenderer()
-        self.T = ""
+        self.markdown = MarkdownWithMath(renderer=self.renderer) # reused for each rendering
+        self.T = []
 
     def render_markdown(self):
         """Trigger markdown rendering to add components to docx document.
         The internal markdown text variable T is being reset empty."""
         if self.T:
-            document = self.document # document variable will be used in exec below
-            if isinstance(self.T, str):
-                exec(MarkdownWithMath(renderer=self.renderer)(self.T))
-            else: # case of T is list of strings, does not apply in current code
-                exec(MarkdownWithMath(renderer=self.renderer)('\n'.join(self.T)))
-            self.T = ""
+            src = self.T if isinstance(self.T, str) else '\n'.join(self.T)
+            ctx = DocxRenderContext(self.document)
+            for op in self.markdown(src):
+                op(ctx)
+            self.T = []
 
     def save_document(self, fname):
         self.render_markdown()
         self.document.save(fname)
 
     def add_figure(self, fig_uri):
-        self.T += f"![]({fig_uri})\n\n"
+        self.T.append(f"![]({fig_uri})\n")
 
     def add_text(self, text):
-        self.T += text+"\n"
+        self.T.append(text)
 
 # ----------------------------------------------------------------------------
 # app specific custom api, e.g. for different figure drawing backends
 
 class MarkdownDocument(MarkdownDocumentBase):
-    """Markdown document with plotly figure support."""
+    """Markdown document with plotly figure support.
+    Plotly figures are rendered to images concurrently in the background, starting when
+    they are added. The markdown rendering waits for the pending images."""
 
     images_folder = None # location where images are stored
     plotly_fig_opts = None # options to plotly.Figure.write_image call
+    max_workers = None # number of threads used to render figures
 
     def __init__(self, images_folder='images'):
         super().__init__()
         self.images_folder = images_folder
         self.plotly_fig_opts = dict(width=600, height=350, scale=2)
+        self.max_workers = os.cpu_count()
+        self._executor = None
+        self._pending_figs = []
 
     def add_plotly_figure(self, fig, fig_id=None, caption=None):
-        """Write plotly figure to disk under images_folder and insert markdown reference to it.
+        """Insert markdown reference to plotly figure. The figure image is written
+        to disk under images_folder in the background, call render_pending_figures
+        to wait for it.
         Args:
-        fig - plotly.graph_objects.Figure object
+        fig - plotly.graph_objects.Figure object, later changes to it do not affect
+              the inserted figure
         fig_id - prefix of .png filename for the figure. If None,
                  the figure will be inserted directly via data: uri,
                  not creating a file in `images_folder`
         caption - Caption to display under the figure
         """
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers or 1)
+        # export a copy of the figure in its current state
+        fig = type(fig)(fig)
+        future = self._executor.submit(self._plotly_figure_uri, fig, fig_id, dict(self.plotly_fig_opts))
+        # reserve the position in T, the reference is filled in by render_pending_figures
+        self._pending_figs.append((len(self.T), future))
+        self.T.append(None)
+        if not caption is None:
+            self.add_text(caption)
+
+    def _plotly_figure_uri(self, fig, fig_id, fig_opts):
         if not fig_id is None:
             fig_uri = f'{self.images_folder}/{fig_id}.png'
-            fig.write_image(fig_uri, **self.plotly_fig_opts)
+            fig.write_image(fig_uri, **fig_opts)
         else:
-            img_bytes = fig.to_image(format="png", **self.plotly_fig_opts)
+            img_bytes = fig.to_image(format="png", **fig_opts)
             from datatools_bdh.data_uri import bytes_to_uri
             fig_uri = bytes_to_uri(img_bytes)
-        self.add_figure(fig_uri)
-        if not caption is None:
-            self.add_text(caption)
+        return fig_uri
+
+    def render_pending_figures(self):
+        """Wait for the images of all figures added since the last call and
+        insert their markdown references into T."""
+        while self._pending_figs:
+            pos, future = self._pending_figs[0]
+            try:
+                fig_uri = future.result()
+            except Exception:
+                # leave out the failed figure, so that the rest of the document still renders
+                self.T[pos] = ''
+                raise
+            else:
+                self.T[pos] = f"![]({fig_uri})\n"
+            finally:
+                self._pending_figs.pop(0)
+
+    def render_markdown(self):
+        self.render_pending_figures()
+        super().render_markdown()
+
+    def save_document(self, fname):
+        try:
+            super().save_document(fname)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
@@ -36,20 +36,22 @@ def write_pb_docx(landscape=False):
 #write_pb = write_pb_docxtpl
 write_pb = write_pb_docx
 
+_page_break_after = re.compile(r'page-break-after *: *always')
+_page_break_landscape_after = re.compile(r'page-break-landscape-after *: *always')
+
 def pagebreak(key, value, format, meta):
-  try:
-    if key == 'Div':
-      [[ident, classes, kvs], contents] = value
-      kvd = dict(kvs)
-      if re.search(r'page-break-after *: *always', kvd['style']):
-        return write_pb(landscape=False)
-      elif re.search(r'page-break-landscape-after *: *always', kvd['style']):
-        return write_pb(landscape=True)
-    elif key == 'Image':
-      [[ident, classes, kvs], something, contents] = value
-      return Image([ident, classes, kvs], something, contents)
-  except KeyError:
-    pass
+  if key == 'Div':
+    [[ident, classes, kvs], contents] = value
+    style = dict(kvs).get('style')
+    if style is None:
+      return
+    if _page_break_after.search(style):
+      return write_pb(landscape=False)
+    elif _page_break_landscape_after.search(style):
+      return write_pb(landscape=True)
+  elif key == 'Image':
+    [[ident, classes, kvs], something, contents] = value
+    return Image([ident, classes, kvs], something, contents)
 
 if __name__ == "__main__":
   toJSONFilter(pagebreak)
@@ -2,12 +2,14 @@
 
 import pandas as pd
 import numpy as np
-from bisect import bisect_left
 import datetime
+import io
 import os
 import re
+import threading
+from collections import OrderedDict
 
-from .utils import gen_filename
+from .utils import ensure_list, gen_filename, dataframe_key, cache_get, cache_put
 from .data_uri import bytes_to_uri
 from .ipython import HTML
 
@@ -23,22 +25,26 @@ def tabulate_list(lst):
                              'props': [('display', 'none')]}])
          .render(escape=False))
 
+_enclosing_p_re = re.compile("(^<P>|</P>$)", flags=re.IGNORECASE)
+__markdown = None
+
+def _markdown():
+    global __markdown
+    if __markdown is None:
+        from markdown import markdown
+        __markdown = markdown
+    return __markdown
+
 def markdown_to_html(non_p_string) -> str:
     ''' Strip enclosing paragraph marks, <p> ... </p>, 
         which markdown() forces, and which interfere with some jinja2 layout
     '''
-    from markdown import markdown as markdown_to_html_with_p
-    return re.sub("(^<P>|</P>$)", "", markdown_to_html_with_p(non_p_string), flags=re.IGNORECASE)
+    return _enclosing_p_re.sub("", _markdown()(non_p_string))
 
 # ---------------------------------------------------------------------------
 # dataframe to SVG conversion via command line tools
 
-def make_table_html(df, title=''):
-    '''
-    Write an entire dataframe to an HTML string with nice formatting.
-    '''
-
-    result = '''
+_TABLE_HTML_HEAD = '''
 <html>
 <head>
 <style>
@@ -72,22 +78,36 @@ def make_table_html(df, title=''):
 </head>
 <body>
     '''
-    #-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Oxygen-Sans,Ubuntu,Cantarell,"Helvetica Neue", sans-serif
-    result += '<h2> %s </h2>' % title
-    if type(df) == pd.io.formats.style.Styler:
-        result += df.render()
-    else:
-        result += df.to_html(classes='wide', escape=False)
-    result += '''
+_TABLE_HTML_TAIL = '''
 </body>
 </html>
 '''
-    return result
+
+def write_table_html(df, f, title=''):
+    '''
+    Write an entire dataframe as HTML with nice formatting to the open text file `f`.
+    The table is written to `f` directly, without building the whole HTML string first.
+    '''
+    f.write(_TABLE_HTML_HEAD)
+    #-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Oxygen-Sans,Ubuntu,Cantarell,"Helvetica Neue", sans-serif
+    f.write('<h2> %s </h2>' % title)
+    if type(df) == pd.io.formats.style.Styler:
+        f.write(df.render())
+    else:
+        df.to_html(buf=f, classes='wide', escape=False)
+    f.write(_TABLE_HTML_TAIL)
+
+def make_table_html(df, title=''):
+    '''
+    Write an entire dataframe to an HTML string with nice formatting.
+    '''
+    buf = io.StringIO()
+    write_table_html(df, buf, title=title)
+    return buf.getvalue()
 
 def write_to_html_file(df_sl, filename='out.html'):
-    result = make_table_html(df_sl)
     with open(filename, 'w', encoding='utf-8') as f:
-        f.write(result)
+        write_table_html(df_sl, f)
 
 def make_df_svg_uri(df_sl, fnhead, show_errors=False,
                     do_remove_files=True,
@@ -95,34 +115,202 @@ def make_df_svg_uri(df_sl, fnhead, show_errors=False,
     """Display a dataframe as formatted HTML and capture as SVG in URI form.
     The URI can be used in an <img> tag to display the dataframe as SVG.
     """
-    fnbase = f"{fnhead}_{gen_filename()}"
-    outfile = f'{fnbase}.html'
-    pdffile = f'{fnbase}.pdf'
-    svgfile = f'{fnbase}.svg'
-    write_to_html_file(df_sl, filename=outfile)
-    #--disable-smart-shrinking 
-    # --page-width 8in --page-height 11in\
-    if show_errors:
-        debug_err = ''
-        debug_std = ''
-    else:
-        debug_err = '2> /dev/null'
-        debug_std = '> /dev/null'
-
-    os.system(f"wkhtmltopdf --dpi 120 -T 0 -B 0 -L 0 -R 0 --encoding utf-8 --custom-header 'meta' 'charset=utf-8' "
-              f"{outfile} {pdffile} {debug_err}")
-    os.system(f"pdfcrop {pdffile} {debug_std}")
-    #os.system(f"inkscape -l {svgfile} --export-area-drawing --vacuum-defs {pdffile}")
-    os.system(f"inkscape {pdffile.replace('.pdf','-crop.pdf')} --vacuum-defs --export-filename={svgfile} {debug_err}")
-    #os.system(f"inkscape {pdffile} --vacuum-defs --export-filename={svgfile} {debug_err}")
-    # os.system(f"pdf2svg {pdffile.replace('.pdf','-crop.pdf')} {svgfile}")
-    # os.system("sleep .5")
-    if do_optimize_svg:
-        os.system(f"svgo {svgfile} {debug_std}")
-    dat_uri = bytes_to_uri(open(svgfile,'rb').read(), imgtype='svg+xml')
-    if do_remove_files:
-        os.system(f"rm -f {fnbase}*")
-    return dat_uri
+    return make_df_svg_uris([df_sl], fnhead, show_errors=show_errors,
+                            do_remove_files=do_remove_files,
+                            do_optimize_svg=do_optimize_svg)[0]
+
+def make_df_svg_uris(dfs, fnhead, show_errors=False,
+                     do_remove_files=True,
+                     do_optimize_svg=False):
+    """Capture several dataframes as SVG in URI form, see make_df_svg_uri.
+    If weasyprint and PyMuPDF are installed, the conversion is done in process.
+    Otherwise, the command line tools wkhtmltopdf, pdfcrop and inkscape are used, where
+    the PDF to SVG conversion is done by an inkscape shell process that is kept running,
+    avoiding its startup time for each dataframe.
+    Intermediate files are written to a temporary directory, or, if do_remove_files is
+    False, kept in the current working directory as {fnhead}_<unique id>.html/.pdf/.svg.
+    Results are cached by dataframe content, unless do_remove_files is False.
+    Returns: list of data URIs in the order of `dfs`
+    """
+    dfs = list(dfs)
+    keys = [_svg_cache_key(df_sl, do_optimize_svg) if do_remove_files else None for df_sl in dfs]
+    dat_uris = [cache_get(__svg_uri_cache, key) for key in keys]
+    missing = [i for i, uri in enumerate(dat_uris) if uri is None]
+    if missing:
+        new_uris = _make_df_svg_uris([dfs[i] for i in missing], fnhead, show_errors=show_errors,
+                                     do_remove_files=do_remove_files,
+                                     do_optimize_svg=do_optimize_svg)
+        for i, uri in zip(missing, new_uris):
+            dat_uris[i] = uri
+            cache_put(__svg_uri_cache, keys[i], uri, SVG_CACHE_SIZE)
+    return dat_uris
+
+SVG_CACHE_SIZE = 32 # number of cached SVG data URIs
+__svg_uri_cache = OrderedDict()
+
+def _svg_cache_key(df_sl, do_optimize_svg):
+    key = dataframe_key(df_sl)
+    return None if key is None else (key, do_optimize_svg)
+
+def clear_svg_cache():
+    """Drop cached results of make_df_svg_uri and make_df_svg_uris"""
+    __svg_uri_cache.clear()
+
+def _make_df_svg_uris(dfs, fnhead, show_errors, do_remove_files, do_optimize_svg):
+    if _svg_inprocess_available():
+        svgs = [_html_to_svg(make_table_html(df_sl)) for df_sl in dfs]
+        if do_optimize_svg:
+            svgs = [_optimize_svg(svg, show_errors) for svg in svgs]
+        return [bytes_to_uri(svg, imgtype='svg+xml') for svg in svgs]
+
+    if not dfs:
+        return []
+    import subprocess, tempfile, contextlib
+    run_opts = dict(check=True)
+    if not show_errors:
+        run_opts.update(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # work in a private directory, which is removed afterwards. If do_remove_files is False,
+    # the files are kept in the current working directory instead
+    tmpdir = (tempfile.TemporaryDirectory(prefix=f"{fnhead}_") if do_remove_files
+              else contextlib.nullcontext(os.curdir))
+    with tmpdir as td:
+        fnbases = [os.path.join(td, f"{fnhead}_{gen_filename()}") for _ in dfs]
+        for df_sl, fnbase in zip(dfs, fnbases):
+            outfile = f'{fnbase}.html'
+            pdffile = f'{fnbase}.pdf'
+            write_to_html_file(df_sl, filename=outfile)
+            #--disable-smart-shrinking 
+            # --page-width 8in --page-height 11in\
+            subprocess.run(["wkhtmltopdf", "--dpi", "120", "-T", "0", "-B", "0", "-L", "0", "-R", "0",
+                            "--encoding", "utf-8", "--custom-header", "meta", "charset=utf-8",
+                            outfile, pdffile], **run_opts)
+            subprocess.run(["pdfcrop", pdffile, f'{fnbase}-crop.pdf'], **run_opts)
+        svgfiles = [f'{fnbase}.svg' for fnbase in fnbases]
+        shell = _inkscape_shell()
+        for fnbase, svgfile in zip(fnbases, svgfiles):
+            shell.convert(f'{fnbase}-crop.pdf', svgfile)
+        if do_optimize_svg:
+            subprocess.run(["svgo", *svgfiles], **run_opts)
+        dat_uris = []
+        for svgfile in svgfiles:
+            with open(svgfile, 'rb') as fh:
+                dat_uris.append(bytes_to_uri(fh.read(), imgtype='svg+xml'))
+    return dat_uris
+
+class _InkscapeShell:
+    """Inkscape process in --shell mode, converting files without restarting inkscape"""
+    prompt = b'> '
+    timeout = 60 # seconds to wait for inkscape to respond
+
+    def __init__(self):
+        import subprocess, queue
+        self.lock = threading.Lock()
+        self.proc = subprocess.Popen(['inkscape', '--shell'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+        # stdout is read by a thread, so that waiting for a response can time out
+        self.output = queue.Queue()
+        threading.Thread(target=self._read_stdout, daemon=True).start()
+        self._read_response()
+
+    def _read_stdout(self):
+        for chunk in iter(lambda: self.proc.stdout.read1(4096), b''):
+            self.output.put(chunk)
+        self.output.put(b'') # end of output
+
+    def _read_response(self):
+        """Read inkscape output up to its next input prompt.
+        If the prompt does not appear within `timeout` seconds, inkscape is terminated,
+        it is restarted by the next call of _inkscape_shell()."""
+        import time, queue
+        out = b''
+        deadline = time.monotonic() + self.timeout
+        while not (out == self.prompt or out.endswith(b'\n' + self.prompt)):
+            try:
+                chunk = self.output.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.proc.kill()
+                self.proc.wait()
+                raise RuntimeError(f"inkscape shell did not respond within {self.timeout} seconds")
+            if not chunk:
+                raise RuntimeError("inkscape shell exited unexpectedly")
+            out += chunk
+        return out[:-len(self.prompt)].decode(errors='replace')
+
+    def convert(self, infile, outfile):
+        """Convert `infile` to `outfile`, export type is given by the extension of `outfile`"""
+        with self.lock:
+            self.proc.stdin.write(f'file-open:{infile}; vacuum-defs; '
+                                  f'export-filename:{outfile}; export-do; file-close\n'.encode())
+            self.proc.stdin.flush()
+            self._read_response()
+        if not os.path.exists(outfile):
+            raise RuntimeError(f"inkscape failed to convert {infile} to {outfile}")
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        if self.is_alive():
+            import subprocess
+            try:
+                self.proc.stdin.write(b'quit\n')
+                self.proc.stdin.close()
+                self.proc.wait(timeout=self.timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+
+__inkscape_shell = None
+__inkscape_shell_lock = threading.Lock()
+
+def _inkscape_shell():
+    """Inkscape shell process shared by all conversions, (re)started on demand"""
+    global __inkscape_shell
+    with __inkscape_shell_lock:
+        if __inkscape_shell is None or not __inkscape_shell.is_alive():
+            import atexit
+            __inkscape_shell = _InkscapeShell()
+            atexit.register(__inkscape_shell.close)
+        return __inkscape_shell
+
+_svg_inprocess = None
+
+def _svg_inprocess_available():
+    """Check once whether the packages for in process HTML to SVG conversion can be used"""
+    global _svg_inprocess
+    if _svg_inprocess is None:
+        try:
+            # weasyprint raises OSError, if its pango library is missing
+            import weasyprint, pymupdf
+            _svg_inprocess = True
+        except (ImportError, OSError):
+            _svg_inprocess = False
+    return _svg_inprocess
+
+def _html_to_svg(html):
+    """Render HTML via weasyprint and convert the first page to SVG via PyMuPDF.
+    Like pdfcrop, the page is cropped to the bounding box of its drawn content.
+    Returns: SVG as bytes
+    """
+    import weasyprint, pymupdf
+    pdf = weasyprint.HTML(string=html).write_pdf()
+    with pymupdf.open(stream=pdf, filetype='pdf') as doc:
+        page = doc[0]
+        rects = [pymupdf.Rect(r) for _, r in page.get_bboxlog()]
+        if rects:
+            bbox = rects[0]
+            for r in rects[1:]:
+                bbox |= r
+            page.set_cropbox(bbox & page.mediabox)
+        return page.get_svg_image().encode('utf-8')
+
+def _optimize_svg(svg, show_errors=False):
+    """Pass SVG bytes through svgo"""
+    import subprocess
+    return subprocess.run(['svgo', '-i', '-', '-o', '-'], input=svg, check=True,
+                          stdout=subprocess.PIPE,
+                          stderr=None if show_errors else subprocess.DEVNULL).stdout
 
 def dataframe_svg_html(df_sl, width="90%"):
     dat_uri = make_df_svg_uri(df_sl, fnhead='sl_table')
@@ -132,10 +320,8 @@ def hide_repeated_cells(x):
     """Hide values that are the same as the row above"""
     c1='visibility:hidden'
     c2=''
-    cond = x.iloc[:-1,:].values == x.iloc[1:,:].values
-    cr = cond[0].copy()
-    cr[:] = False
-    cond = np.vstack([cr,cond])
+    # the first row is compared to the NaN row shifted in, which is never equal
+    cond = x.eq(x.shift()).to_numpy()
     df1 = pd.DataFrame(np.where(cond,c1,c2),columns=x.columns,index=x.index)
     return df1
 
@@ -144,14 +330,14 @@ def hide_repeated_cells(x):
 def index_columns(df, none_name=None):
     """Return list of column names that form the (multi-)index or None, if index is a single unnamed
     column."""
-    try:
-        return [l.name for l in df.index.levels]
-    except AttributeError:
-        name = df.index.name
-        if name is not None:
-            return [name]
-        elif none_name is not None:
-            return [none_name]
+    if isinstance(df.index, pd.MultiIndex):
+        return list(df.index.names)
+    name = df.index.name
+    if name is not None:
+        return [name]
+    elif none_name is not None:
+        return [none_name]
+    return None
 
 
 def split_by_index(df, split_idx):
@@ -168,44 +354,48 @@ def split_by_index(df, split_idx):
              - **high_df** (`pandas.DataFrame`) - DataFrame containing index values greater than or
                equal to split_idx.
     """
-    try:
-        idx = df.index.get_loc(split_idx)
-    except KeyError:
-        idx = bisect_left(df.index, split_idx)
-    return df.iloc[:idx, :], df.iloc[idx:, :]
+    # position of split_idx, if present, otherwise its insertion point
+    idx = df.index.searchsorted(split_idx, side='left')
+    return df.iloc[:idx], df.iloc[idx:]
 
 
 def update_on(df, dfu, on=None):
-    """Use DataFrame.update() function inplace, matching on any set of columns."""
+    """Use DataFrame.update() function inplace, matching on any set of columns.
+    Columns in `on` may also be index levels of `df` or `dfu`. The index of `df` is kept.
+    """
     if on:
-        inames = index_columns(df)
-        uinames = index_columns(dfu)
-        df.reset_index(inplace=True)
-        df.set_index(on, inplace=True)
-        if uinames is not None:
-            df.update(dfu.reset_index().set_index(on))
-        else:
-            # id dfu index is unnamed, drop it to avoid collision with df index
-            df.update(dfu.set_index(on))
-        if inames is None:
-            df.reset_index(inplace=True)
-            df.set_index('index', inplace=True)
-            df.index.name = None
+        on = ensure_list(on)
+        def key_columns(d):
+            return d if set(on).issubset(d.columns) else d.reset_index()
+        update_cols = [c for c in dfu.columns if c in df.columns and c not in on]
+        df_keys, dfu_keys = key_columns(df), key_columns(dfu)
+        if len(on) == 1 and dfu_keys[on[0]].is_unique:
+            # single key, look up the position of the matching dfu row for each df row
+            pos = pd.Index(dfu_keys[on[0]]).get_indexer(df_keys[on[0]])
+            new_cols = {c: dfu_keys[c].to_numpy()[pos] for c in update_cols}
+            matched = pos >= 0
         else:
-            df.reset_index(inplace=True)
-            df.set_index('index', inplace=True)
+            # single left join keeps the row order of df, each df row matches at most one dfu row
+            merged = df_keys[on].merge(dfu_keys[on + update_cols],
+                                       on=on, how='left', validate='many_to_one')
+            new_cols = {c: merged[c].to_numpy() for c in update_cols}
+            matched = True
+        for c, new in new_cols.items():
+            mask = matched & pd.notna(new)
+            if mask.any():
+                df.loc[mask, c] = new[mask]
     else:
         df.update(dfu)
 
 
 def dataframe_schema(columns, dtypes):
     """Create empty pd.DataFrame with columns of given datatypes"""
-    df_dict = {cname: pd.Series([], dtype=dtype) for cname, dtype in zip(columns, dtypes)}
-    return pd.DataFrame(df_dict)
+    return pd.DataFrame(columns=columns, dtype=object).astype(dict(zip(columns, dtypes)))
 
 
 def remove_microsecond(ts):
-    return pd.Timestamp(year=ts.year, month=ts.month, day=ts.day, hour=ts.hour, second=ts.second)
+    """Truncate timestamp `ts` to full seconds. For a Series use s.dt.floor('s')."""
+    return ts.floor('s')
 
 
 def get_next_index(df, index_val, lock_bound=False, inc=+1):
@@ -224,33 +414,37 @@ def get_next_index(df, index_val, lock_bound=False, inc=+1):
 
     :return: neighbouring index value
     """
-    index_value_iloc = df.index.get_loc(index_val)
+    index_value_iloc = df.index.get_indexer([index_val])[0]
+    if index_value_iloc < 0:
+        raise KeyError(index_val)
     next_iloc = index_value_iloc + inc
-    try:
-        next_index_value = df.index[next_iloc]
-    except IndexError:
-        if lock_bound:
-            return index_value_iloc
-        else:
-            next_index_value = None
-
-    return next_index_value
+    n = len(df.index)
+    if 0 <= next_iloc < n:
+        return df.index[next_iloc]
+    return df.index[min(max(next_iloc, 0), n - 1)] if lock_bound else None
 
 # ---------------------------------------------------------------------------
 
 def value_counts_weighted(df, fields, weight_name='weight', count_name=None, ascending=None):
     """Replacement for pandas DataFrame.value_counts() summing the column given in `weight_name`.
-       To obtain raw counts, as provided by original value_counts, use a column with contant 1.
+       To obtain raw counts, as provided by original value_counts, use weight_name=None.
        Args:
            df          - dataframe to perform value counts for
            fields      - fields whose values should be counted
-           weight_name - name of weight column
+           weight_name - name of weight column, None to count rows
            count_name  - name for resulting field containing counts (default: 'count')
-           ascending   - True/False for sorting order, None to keep original order (default)
+           ascending   - True/False for sorting order of counts, None to keep the sorted order
+                         of the values in `fields` (default)
         Returns:
             pandas Series of counts
     """
-    vc_df = df.groupby(fields)[weight_name].sum()
+    # group keys only need sorting, if the counts are not sorted afterwards
+    grouped = df.groupby(fields, observed=True, sort=ascending is None)
+    if weight_name is None:
+        # plain row counts, no need to sum a column of ones
+        vc_df = grouped.size()
+    else:
+        vc_df = grouped[weight_name].sum()
     if ascending is None:
         pass
     elif isinstance(fields, str):
@@ -259,13 +453,7 @@ def value_counts_weighted(df, fields, weight_name='weight', count_name=None, asc
             count_name = fields
             vc_df.index.name = None
     else:
-        # If multiple fields are use, vc_df is going to have a multi-index.
-        # Construct a multi-index that produces the sorted order from first to last field
-        # TODO: check this implementation or remove it
-        def gen_all():
-            for field in fields:
-                yield value_counts_weighted(df, field).sort_values(ascending=ascending).index
-        vc_df = vc_df.loc[tuple(list(gen_all()))]
+        vc_df = vc_df.sort_values(ascending=ascending)
     if not count_name is None:
         vc_df = vc_df.rename(count_name)
     return vc_df
@@ -275,17 +463,12 @@ def make_weekday_df(start_date, end_date):
     The 'date' column is a string formatted as, e.g. 2019/07/25,
     the 'day' column is the full weekday name, lower case (sunday, monday, ...)
     """
-    delta = datetime.timedelta(days=1)
-    day = []
-    date = []
-    while start_date <= end_date:
-        day.append(start_date.strftime('%A').lower())
-        date.append(str(start_date).replace("-","/"))
-        start_date+= delta
-    df_weekday = pd.DataFrame()
-    df_weekday['date'] = date
-    df_weekday['day'] = day
-    df_weekday['is_weekend'] = df_weekday['day'].isin(['sunday','saturday'])
+    dates = pd.date_range(start_date, end_date, freq='D')
+    df_weekday = pd.DataFrame({
+        'date': dates.strftime('%Y/%m/%d'),
+        'day': dates.day_name().str.lower(),
+    })
+    df_weekday['is_weekend'] = dates.dayofweek >= 5
     return df_weekday
 
 def make_month_start_end_dates(month, year=2019):
@@ -13,10 +13,12 @@ or via
 
 from datatools_bdh import _get_resource_path
 from .utils import ensure_list
+import numpy as np
 import pandas as pd
 
 _rldf = None
 _pccf_df = None
+_pccf_community_rows = None
 
 def _pccf_df():
     return _pccf_df
@@ -30,67 +32,153 @@ def __getattr__(name):
 
 import pickle, os
 
-def init(filename, cachefile=None):
+_DASH_TO_SPACE = str.maketrans('-', ' ')
+
+# pccf fields stored as pandas categoricals
+CATEGORY_FIELDS = ['FSA', 'PR', 'CSDname', 'Comm_Name', 'Community', 'DAuid']
+# text fields stored without surrounding whitespace
+_STRIP_FIELDS = ['CSDname', 'Comm_Name']
+
+try:
+    # keep the remaining text fields in Arrow string buffers rather than one python
+    # object per row, this is pandas' default 'str' dtype from pandas 3 on
+    import pyarrow
+    _TEXT_DTYPE = pd.StringDtype('pyarrow', na_value=np.nan)
+except (ModuleNotFoundError, TypeError):
+    _TEXT_DTYPE = None # pandas default
+
+def init(filename, cachefile=None, force_rebuild=False):
     """Load the raw 2020 Postal code conversion file from given `filename`
        Call this with the location of pccfNat_fccpNat_082020.txt
+       Args:
+           filename - location of the raw pccf text file
+           cachefile - if given, the parsed table is stored in this file and loaded from it
+                       in later calls, unless `filename` was modified after the cache was written.
+                       A .parquet file is used via pandas.to_parquet (requires pyarrow),
+                       any other file name is written with pickle.
+           force_rebuild - parse `filename` and rewrite `cachefile`, even if the cache is current
     """
     global _pccf_df, _rldf
 
-    if not cachefile is None and os.path.exists(cachefile):
+    if not force_rebuild and _is_cache_current(cachefile, filename):
         try:
-            with open(cachefile, "rb") as fh:
-                d = pickle.load(fh)
-                globals().update(d)
-        except EOFError:
-            init(filename, cachefile=None)
-            pass
+            _read_cache(cachefile)
+            return
+        except (EOFError, pickle.UnpicklingError):
+            pass # unreadable cache, parse and rewrite it below
+
+    _rldf = pd.read_csv(_get_resource_path('pccf_2020_record_layout.csv'))
+
+    # load the raw fixed width pccf file as 2-d byte array, one row per record
+    with open(filename, 'rb') as fh:
+        eol = fh.readline()
+        reclen = len(eol)
+        eol = eol[-2:] if eol.endswith(b'\r\n') else eol[-1:]
+        fh.seek(0)
+        buf = np.fromfile(fh, dtype=np.uint8)
+    # skip trailing blank lines, the last record ends with a single line break
+    end = len(buf)
+    while end and int(buf[end-1]) in b'\r\n':
+        end -= 1
+    if buf[end:end+len(eol)].tobytes() == eol:
+        buf = buf[:end+len(eol)]
     else:
+        # last record without line break
+        buf = np.concatenate([buf[:end], np.frombuffer(eol, dtype=np.uint8)])
+    records = buf.reshape(-1, reclen) if len(buf) % reclen == 0 else None
+    if records is None or not (records[:, -1] == ord('\n')).all():
+        raise ValueError(f"{filename} does not consist of fixed width records of length {reclen}")
+
+    def gen_pccf():
+        for pos, size, name, ftype in zip(_rldf['Position'], _rldf['Size'],
+                                          _rldf['Field name'], _rldf['Type']):
+            field_bytes = records[:, pos-1:pos-1+size]
+            if ftype == 'N':
+                # numbers, e.g. LAT/LONG, are converted from the bytes without making strings
+                yield name, np.ascontiguousarray(field_bytes).view(f'S{size}').ravel().astype(float)
+                continue
+            # latin-1 bytes are unicode code points, widen to UCS4 to get the strings
+            col = field_bytes.astype(np.uint32).view(f'U{size}').ravel()
+            if name in CATEGORY_FIELDS:
+                col = _categorical(col, strip=name in _STRIP_FIELDS)
+            elif _TEXT_DTYPE is not None:
+                col = pd.array(col, dtype=_TEXT_DTYPE)
+            yield name, col
+
+    _pccf_df = pd.DataFrame(dict(gen_pccf()))
+
+    # community names repeat for many postal codes, title-case each name once
+    _pccf_df["Community"] = _pccf_df["Comm_Name"].map(
+        {name: name.translate(_DASH_TO_SPACE).title() for name in _pccf_df["Comm_Name"].unique()}
+        ).astype('category')
+    if not cachefile is None:
+        _write_cache(cachefile)
+
+def _categorical(values, strip=False):
+    """Make categorical from array of strings `values`, with optional stripping of whitespace
+    around the values. Stripping is done once per distinct value."""
+    codes, categories = pd.factorize(values, sort=True)
+    if strip:
+        # stripped values may coincide, merge their categories
+        merged, categories = pd.factorize(pd.Index(categories).str.strip(), sort=True)
+        codes = merged[codes]
+    return pd.Categorical.from_codes(codes, categories)
+
+def _is_cache_current(cachefile, filename):
+    """True if `cachefile` exists and is not older than `filename`"""
+    if cachefile is None or not os.path.exists(cachefile):
+        return False
+    return not os.path.exists(filename) or os.path.getmtime(cachefile) >= os.path.getmtime(filename)
+
+def _read_cache(cachefile):
+    global _pccf_df, _rldf
+    if cachefile.endswith('.parquet'):
+        _pccf_df = pd.read_parquet(cachefile)
         _rldf = pd.read_csv(_get_resource_path('pccf_2020_record_layout.csv'))
-
-        # load the raw text pccf file
-        with open(filename,'r', encoding='latin-1') as fh:
-            pctxt = fh.read()
-
-        pclines = pctxt.split('\n')
-
-        pclines = list(filter(lambda l: len(l), pclines)) # keep only non-empty lines
-        pcs = pd.Series(pclines)
-
-        def gen_pccf():
-            for idx, r in _rldf.iterrows():
-                yield r['Field name'], pcs.str[r['Position']-1:r['Position']+r['Size']-1]
-                
-        _pccf_df = pd.DataFrame(dict(gen_pccf()))
-
-        # remove whitespace around string fields
-        _pccf_df["Comm_Name"] = _pccf_df["Comm_Name"].str.strip()
-        _pccf_df["Community"] = _pccf_df["Comm_Name"].str.replace("-"," ").str.title()
-        _pccf_df["CSDname"] = _pccf_df["CSDname"].str.strip()
-        # lat/lon as floating point (N type in record layout)
-        _pccf_df["LAT"] = _pccf_df["LAT"].astype(float)
-        _pccf_df["LONG"] = _pccf_df["LONG"].astype(float)
-        if not cachefile is None:
-            d = dict(_pccf_df=_pccf_df, _rldf=_rldf)
-            with open(cachefile, "wb") as fh:
-                pickle.dump(d, fh)
+    else:
+        with open(cachefile, "rb") as fh:
+            d = pickle.load(fh)
+            globals().update(d)
+    # caches written by earlier versions hold these fields as plain strings
+    for name in CATEGORY_FIELDS:
+        if name in _pccf_df and not isinstance(_pccf_df[name].dtype, pd.CategoricalDtype):
+            _pccf_df[name] = _pccf_df[name].astype('category')
+
+def _write_cache(cachefile):
+    if cachefile.endswith('.parquet'):
+        _pccf_df.to_parquet(cachefile, compression='zstd')
+    else:
+        d = dict(_pccf_df=_pccf_df, _rldf=_rldf)
+        with open(cachefile, "wb") as fh:
+            pickle.dump(d, fh)
 
 def filter_pc(province_filter=None, keep_first_pc=True, drop_da0=True):
     """Remove items from PCCF data frame."""
     global _pccf_df
     if not province_filter is None:
-        _pccf_df = _pccf_df.loc[_pccf_df['Postal code'].str[0] == province_filter]
+        # the FSA is the start of the postal code, test the first letter once per category
+        fsa = _pccf_df['FSA'].cat
+        _pccf_df = _pccf_df.loc[(fsa.categories.str[0] == province_filter)[fsa.codes]]
     if drop_da0:
         _pccf_df = _pccf_df.loc[_pccf_df['DAuid'] != '00000000']
     if keep_first_pc:
         _pccf_df = _pccf_df.groupby('Postal code').first().reset_index()
 
+def _community_rows():
+    """Mapping of Community to row positions in _pccf_df, rebuilt when _pccf_df is replaced"""
+    global _pccf_community_rows
+    if _pccf_community_rows is None or _pccf_community_rows[0] is not _pccf_df:
+        _pccf_community_rows = (_pccf_df, _pccf_df.groupby('Community', sort=False, observed=True).indices)
+    return _pccf_community_rows[1]
+
 def get_community_codes(community, field="DAuid"):
     """Get geographical region codes for given community or city.
     Args:
         community - city name
         field - "DAuid" or "Postal code" or "FSA"
     """
-    return _pccf_df.loc[_pccf_df['Community'] == community, field].unique()
+    rows = _community_rows().get(community, [])
+    return np.asarray(_pccf_df[field].iloc[rows].unique())
 
 def get_communities_codes(communities, fields=None, community_field='Community'):
     """From the postal code conversion file, select entries for the `communities`.
@@ -4,7 +4,9 @@ import matplotlib.pyplot as plt
 import matplotlib as mpl
 
 import warnings
-from ..ipython import render_uri, render_bytes, display, HTML
+import io
+from ..ipython import render_uri, render_bytes, display, HTML # noqa: F401, render_uri is re-exported
+from ..data_uri import bytes_to_uri
 from .maps import *
 
 # ---------------------------------------------------------------------------
@@ -18,7 +20,9 @@ def get_axis_bounds(ax=None):
     """
     if ax is None:
         ax = plt.gca()
-    return np.array([ax.get_ylim(), ax.get_xlim()]).T
+    ymin, ymax = ax.get_ylim()
+    xmin, xmax = ax.get_xlim()
+    return np.array([[ymin, xmin], [ymax, xmax]])
 
 def translate_latlon_bounds(fig_bounds, lon_shift=.9, lat_shift=.7, aspect=.7, scale=1):
     """Generate bounds for a colorbar or legend to place next to a figure overlay.
@@ -43,21 +47,23 @@ def translate_latlon_bounds(fig_bounds, lon_shift=.9, lat_shift=.7, aspect=.7, s
     """
     # [ [bottom or S,  left or W], 
     #   [   top or N, right or E] ] = fig_bounds # [[s, w], [n, e]]
-    cbar_fig_bounds = fig_bounds.copy()
-    cbar_width = cbar_fig_bounds[:,1] @ [-1,1]
-    nb = cbar_fig_bounds[:,1] + cbar_width * lon_shift
-    cbar_fig_bounds[:,1] = nb
-    cbar_height = cbar_fig_bounds[:,0] @ [-1,1]
-    nb = cbar_fig_bounds[:,0] + cbar_height * lat_shift
-    cbar_fig_bounds[:,0] = nb
-#    cbar_fig_bounds[0,0] = cbar_fig_bounds[1,0] - cbar_height * aspect
-    cbar_hw = cbar_fig_bounds.T @ [-1,1]
-    cbar_hw[0] *= aspect
-    cbar_c = cbar_fig_bounds.T @ [.5, .5]
-    cbar_fig_bounds = np.array([cbar_c - scale * .5 * cbar_hw,
-                                cbar_c + scale * .5 * cbar_hw])
-    #cbar_fig_bounds[1,:] = cbar_fig_bounds[0,:] + cbar_hw * scale
-    return cbar_fig_bounds
+    (s, w), (n, e) = fig_bounds
+    s, w, n, e = _translate_latlon_bounds_core(float(s), float(w), float(n), float(e),
+                                               lon_shift, lat_shift, aspect, scale)
+    return np.array([[s, w], [n, e]])
+
+def _translate_latlon_bounds_core(s, w, n, e, lon_shift, lat_shift, aspect, scale):
+    """Scalar part of translate_latlon_bounds, returns translated (s, w, n, e)"""
+    # plain float arithmetic, this is cheaper than any array or JIT dispatch for 4 values
+    cbar_width = e - w
+    cbar_height = n - s
+    # center of the shifted bounds, width and height are unchanged by the shift
+    cbar_clat = .5 * (s + n) + cbar_height * lat_shift
+    cbar_clon = .5 * (w + e) + cbar_width * lon_shift
+    half_h = scale * .5 * cbar_height * aspect
+    half_w = scale * .5 * cbar_width
+    return (cbar_clat - half_h, cbar_clon - half_w,
+            cbar_clat + half_h, cbar_clon + half_w)
 
 # ---------------------------------------------------------------------------
 # Generic utility functions
@@ -72,8 +78,12 @@ def set_font(size, family='sans-serif', weight='normal'):
 def set_xticklabels_nowarn(ax, xticks=None, autoscale=1000, suffix="k"):
     """Adjust xticklabels to abbreviated multiples of 1000 (or value of autoscale)"""
     if xticks is None:
-        xticks = pd.Series(ax.get_xticks()/autoscale).astype(int).astype(str) + suffix
-    with warnings.catch_warnings(record=True) as w:
+        # labels are formatted on draw, fixed labels would warn and not follow changes of the ticks
+        ax.xaxis.set_major_formatter(mpl.ticker.FuncFormatter(
+            lambda x, pos: f"{int(x/autoscale)}{suffix}"))
+        return
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
         ax.set_xticklabels(xticks)
 
 @mpl.ticker.FuncFormatter
@@ -97,9 +107,9 @@ def savefig_uri(**kwargs):
        Example: savefig_uri(format='png', transparent=True)
        See also: render_uri()
     """
-    plt_savefig = lambda buf: plt.savefig(buf, **kwargs)
-    return render_uri(plt_savefig,
-                      format=get_imgtype(kwargs.get('format', 'png')))
+    buf = io.BytesIO()
+    plt.savefig(buf, **kwargs)
+    return bytes_to_uri(buf, imgtype=get_imgtype(kwargs.get('format', 'png')))
 
 def plot_show_svg_html(width="90%", do_close=True):
     """Capture plot as SVG and display as HTML img with display `width` control.
@@ -207,12 +217,14 @@ def make_datatable(cells, colors,
 
 def matrix_to_df(mat):
     """Convert 2D numpy array to melted dataframe with (row, col) multi-index"""
-    return (pd.DataFrame(mat)
-                    .reset_index() # 'index' is row number
-                    .melt(id_vars='index') # also: 'variable' is column id
-                    .rename(columns={'index':'row','variable':'column'})
-                    .set_index(['row','column'])
-                    )
+    mat = np.asarray(mat)
+    nrows, ncols = mat.shape
+    # column by column, the order that DataFrame.melt produces;
+    # melt gives the 'column' level the object dtype of the column labels
+    index = pd.MultiIndex.from_arrays([np.tile(np.arange(nrows), ncols),
+                                       pd.Index(np.repeat(np.arange(ncols), nrows), dtype=object)],
+                                      names=['row', 'column'])
+    return pd.DataFrame({'value': mat.ravel(order='F')}, index=index)
 
 def make_cells(columns, rows):
     """Make a dataframe of cell contents and a matrix of colors.
@@ -305,9 +317,10 @@ def make_cmap_df(cmap, hex=False):
     display_color_column(hexcol.T)
     ```
     """
-    cmap_df = pd.DataFrame((list(c for c in cmap(i)) for i in range(cmap.N)), columns=list('RGBA'))
+    rgba = cmap(np.arange(cmap.N)) # (N, 4) array of all colors in one call
+    cmap_df = pd.DataFrame(rgba, columns=list('RGBA'))
     if hex:
-        cmap_df = cmap_df.assign(color=lambda x: x.apply(mpl.colors.rgb2hex, axis=1))
+        cmap_df['color'] = [mpl.colors.rgb2hex(c) for c in rgba]
     return cmap_df
 
 # ------------------------------------------------------------------
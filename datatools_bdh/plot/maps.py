@@ -13,29 +13,50 @@ try:
 except ModuleNotFoundError:
     pass
 
-from ..utils import extend_range, isnumber
+from collections import OrderedDict
+
+from ..utils import extend_range, isnumber, dataframe_key, cache_get, cache_put
 from .colormaps import alpha_from_max
 
 # ---------------------------------------------------------------------------
 # generic geospatial utils
 
+_EARTH_DIAMETER_KM = 2 * 6371
+_DEG_TO_RAD = math.pi / 180
+_SCALAR_TYPES = (float, int) # includes numpy.float64, checked before np.ndim for speed
+
 def euclidean(lon1, lat1, lon2, lat2):
     "Calculate euclidan distance between two points in km"
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
-    # haversine formula
+    if not (isinstance(lon1, _SCALAR_TYPES) and isinstance(lat1, _SCALAR_TYPES)
+            and isinstance(lon2, _SCALAR_TYPES) and isinstance(lat2, _SCALAR_TYPES)):
+        if np.ndim(lon1) or np.ndim(lat1) or np.ndim(lon2) or np.ndim(lat2):
+            return euclidean_vector(lon1, lat1, lon2, lat2)
+        # other scalars, e.g. numpy.float32, are computed in double precision
+        lon1, lat1, lon2, lat2 = float(lon1), float(lat1), float(lon2), float(lat2)
+    # haversine formula, with math functions being faster than numpy for single points
+    lat1 *= _DEG_TO_RAD
+    lat2 *= _DEG_TO_RAD
+    sin_dlat = math.sin((lat2 - lat1) * .5)
+    sin_dlon = math.sin((lon2 - lon1) * (.5 * _DEG_TO_RAD))
+    a = sin_dlat * sin_dlat + math.cos(lat1) * math.cos(lat2) * sin_dlon * sin_dlon
+    return float(_EARTH_DIAMETER_KM * math.asin(math.sqrt(a)))
+
+def euclidean_vector(lon1, lat1, lon2, lat2):
+    "Calculate euclidan distances in km between points given in arrays"
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
     dlon = lon2 - lon1
     dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    # radius of earth in kilometers is 6371
-    km = 6371 * c
-    return float(km)
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    return _EARTH_DIAMETER_KM * np.arcsin(np.sqrt(a))
+
+_SIN_HALF_DEGREE = math.sin(.5 * _DEG_TO_RAD)
 
 def get_aspect_latlon(lalo):
     """Compute aspect ratio of y/x for given lat/lon position in `lalo` tuple."""
-    km_lat = euclidean(*lalo, *lalo+[1,0]) # y is latitude, on axis 0
-    km_lon = euclidean(*lalo, *lalo+[0,1]) # x is longitude, on axis 1
+    # haversine distances of a 1 degree step in latitude (y) and in longitude (x),
+    # the common factor 2 * 6371 cancels in the ratio
+    km_lat = .5 * _DEG_TO_RAD
+    km_lon = math.asin(abs(math.cos(lalo[0] * _DEG_TO_RAD)) * _SIN_HALF_DEGREE)
     return km_lat / km_lon
 
 # ---------------------------------------------------------------------------
@@ -75,9 +96,10 @@ def add_basemap(extent_wesn=None, zoom='auto', source='none',
     image, bounds = contextily.bounds2img(*extent_wsen, zoom=zoom, ll=True, source=source)
 
     bbi = PILImage.fromarray(image).convert('RGBA')
-    bbd = np.array(bbi.getdata(), dtype=int)
+    # alpha_tf works on one row of RGBA values per pixel
+    bbd = np.array(bbi, dtype=np.int32).reshape(-1, 4)
     bbd = alpha_tf(bbd)
-    bbi.putdata(list(map(tuple, bbd)))
+    bbi = PILImage.fromarray(bbd.reshape(bbi.height, bbi.width, 4).astype(np.uint8))
 
     bounds = np.array(bounds)
     bounds_ll = np.array(geopandas.GeoSeries(geopandas.points_from_xy(bounds[[0,1]], bounds[[2,3]],crs=3857),
@@ -93,37 +115,88 @@ DEFAULT_TRI_FILTER_K = 5*1e-3
 
 def dist(x1, y1, x2, y2):
     """Euclidean distance between two points"""
-    return math.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
+    return math.sqrt(_dist2(x1, y1, x2, y2))
+
+def _dist2(x1, y1, x2, y2):
+    """Squared euclidean distance between two points"""
+    dx = x1 - x2
+    dy = y1 - y2
+    return dx * dx + dy * dy
 
 def is_triangle_too_big(x, y, k=DEFAULT_TRI_FILTER_K):
     """Compare length of triangle edges against threshold `k`.
        Triangle corners x and y coordinates are given in arrays `x` and `y`, respectively.
     """
-    return (dist(x[0], y[0], x[1], y[1]) > k) or (dist(x[0], y[0], x[2], y[2]) > k) or (dist(x[2], y[2], x[1], y[1]) > k)
+    k2 = k * k
+    return (_dist2(x[0], y[0], x[1], y[1]) > k2) or (_dist2(x[0], y[0], x[2], y[2]) > k2) or (_dist2(x[2], y[2], x[1], y[1]) > k2)
 
 def filter_triangles(x, y, k=DEFAULT_TRI_FILTER_K):
     """Perform is_triangle_too_big() check on each triangle given in arrays `x` and `y`."""
-    results = []
-    for i in range(x.shape[0]):
-        results.append(is_triangle_too_big(x[i], y[i], k))
-    return np.array(results)
-
-def plot_tripcolor(df, field_name, cmap="rocket", filter_triangles_k=None, ax=None, **kwargs):
+    return _filter_triangle_corners(np.asarray(x, dtype=float).T, np.asarray(y, dtype=float).T, k)
+
+def _filter_triangle_corners(x, y, k):
+    """Like filter_triangles, but with one row of `x` and `y` per triangle corner.
+       This is fastest if the rows are contiguous, e.g. as returned by x[triangles.T]."""
+    # compare squared edge lengths, avoiding the square roots,
+    # scratch buffers are reused for all three edges
+    k2 = k * k
+    n = x.shape[1]
+    too_big = np.zeros(n, dtype=bool)
+    edge_too_big = np.empty(n, dtype=bool)
+    dx = np.empty(n)
+    dy = np.empty(n)
+    for i, j in ((0, 1), (0, 2), (2, 1)):
+        np.subtract(x[i], x[j], out=dx)
+        np.subtract(y[i], y[j], out=dy)
+        dx *= dx
+        dy *= dy
+        dx += dy
+        np.greater(dx, k2, out=edge_too_big)
+        too_big |= edge_too_big
+    return too_big
+
+# triangulations of dense meshes are large, keep only a few
+TRIANGULATION_CACHE_SIZE = 4
+__triangulation_cache = OrderedDict()
+
+def clear_triangulation_cache():
+    """Drop triangulations cached by make_triangulation"""
+    __triangulation_cache.clear()
+
+def make_triangulation(df, filter_triangles_k=None):
+    """Delaunay triangulation of the LONG/LAT points in `df`, see plot_tripcolor.
+    Results are cached by the point coordinates, so that several fields of the same
+    points are plotted without repeating the triangulation. The returned object may
+    be shared with other calls and should not be modified.
+    """
+    x = df["LONG"].to_numpy()
+    y = df["LAT"].to_numpy()
+    k = None
+    if not filter_triangles_k is None:
+        k = filter_triangles_k if isnumber(filter_triangles_k) else DEFAULT_TRI_FILTER_K
+    key = dataframe_key(df[["LONG", "LAT"]])
+    key = None if key is None else (key, k)
+    triang = cache_get(__triangulation_cache, key)
+    if triang is None:
+        triang = tri.Triangulation(x, y)
+        if not k is None:
+            corners = triang.triangles.T
+            triang.set_mask(_filter_triangle_corners(x[corners], y[corners], k))
+        cache_put(__triangulation_cache, key, triang, TRIANGULATION_CACHE_SIZE)
+    return triang
+
+def plot_tripcolor(df, field_name, cmap="rocket", filter_triangles_k=None, ax=None,
+                   triang=None, **kwargs):
     """Use matplotlib.pyplot.tripcolor to visualize scalar quantity on a map.
+    If `triang` is given, it is used instead of make_triangulation(df, filter_triangles_k).
     """
     if ax is None:
         plt.figure(); ax = plt.axes([0,0,1,1])
 
-    x = df["LONG"].to_numpy()
-    y = df["LAT"].to_numpy()
-
     z = df[field_name].fillna(0).to_numpy()
 
-    triang = tri.Triangulation(x, y)
-
-    if not filter_triangles_k is None:
-        k = filter_triangles_k if isnumber(filter_triangles_k) else DEFAULT_TRI_FILTER_K
-        triang.set_mask(filter_triangles(x[triang.triangles], y[triang.triangles]))
+    if triang is None:
+        triang = make_triangulation(df, filter_triangles_k)
     g = ax.tripcolor(triang, z, alpha=.8, shading='flat', edgecolor=None, linewidth=0, cmap=cmap, antialiased=True, **kwargs)
 #    plt.axis('off')
 
@@ -23,6 +23,17 @@ import numpy as np
 from sklearn.utils import Bunch
 
 from scipy.stats import exponpow as _exponpow
+from scipy.stats import truncnorm as _truncnorm
+from scipy.stats import expon as _expon
+from scipy.stats import powerlaw as _powerlaw
+
+# random number generator shared by the sampling functions
+_rng = np.random.default_rng()
+
+def seed(seed=None):
+    """Reset the random number generator of the sampling functions, e.g. for reproducible samples."""
+    global _rng
+    _rng = np.random.default_rng(seed)
 
 # ---------------------------------------------------------------------------
 # Inverse transform sampling
@@ -43,20 +54,17 @@ class ITFSampler(Bunch):
         self.x = np.linspace(self.distribution.ppf(self.cdf_lb, **kwargs),
                              self.distribution.ppf(self.cdf_ub, **kwargs), self.cdf_nsteps)
         self.x0 = np.linspace(self.cdf_lb, self.cdf_ub, self.cdf_nsteps)
-        self.xs = pd.DataFrame(self.distribution.cdf(self.x, **kwargs))
-        self.xsi = self.xs.reset_index().set_index(0)['index']
+        self.cdf = self.distribution.cdf(self.x, **kwargs)
         for k in set(kwargs) - set(locals()):
             self[k] = kwargs[k]
 
     def __call__(self, y):
         y = np.atleast_1d(y)
-        return (
-            self.xsi.reindex(self.xsi.index.union(y), 
-                             # method='ffill',
-                             #fill_value=0
-                             ).interpolate(method='linear')
-                             .reindex(y)
-                    / self.cdf_nsteps * (self.cdf_ub - self.cdf_lb) + self.cdf_lb)
+        # position of y in the tabulated CDF, linearly interpolated between steps,
+        # values below the first CDF step are NaN, above the last step they are clipped
+        pos = np.interp(y, self.cdf, np.arange(self.cdf_nsteps), left=np.nan)
+        return pd.Series(pos / self.cdf_nsteps * (self.cdf_ub - self.cdf_lb) + self.cdf_lb,
+                         index=y)
         # TODO check if this should be divided by (cdf_nsteps-1) instead of cdf_nsteps
         # to enable reaching the upper bound
 
@@ -75,14 +83,16 @@ def make_sample_constrained(in_sample,
     """Draw a number samples from a distribution with constraints, via rejection sampling.
 
     Args:
-        in_sample   - function that determines whether the value in its argument
-                      satisfies the constraint
+        in_sample   - function that returns a boolean mask of the values in its array
+                      argument that satisfy the constraint
         draw_sample - function to generate random sample of size given as argument
         nsamples    - total number of sample values to generate
         oversample  - internally create `oversample` multiple of nsamples, then sort 
                       and return every n-th sample such that only nsamples are retained.
         sample_constraint_rate - if the ratio of samples that pass the in_sample test
-                                 is below this rate, raise an error
+                                 is below this rate, raise a RuntimeError. This also ends
+                                 the sampling if no samples pass at all. If 0 or None, the
+                                 check is disabled.
         unsorted    - if True, return the sample values unsorted. If `oversample` is more than 
                       1, then requesting an unsorted sample requires O(nsamples) more work
                       than the sorted output, produced by default. If `oversample` is 1, i.e.
@@ -94,28 +104,32 @@ def make_sample_constrained(in_sample,
     See also:
         make_sample_bounded
     """
-    samples = []
     nsamples *= oversample
+    samples = np.empty(nsamples)
     nsampled = 0
-    while len(samples) < nsamples:
-        n_add = max(nsamples - len(samples), 0)
-        s = draw_sample(nsamples)
-        s = list(filter(in_sample, s))
-        samples.extend(s[:n_add])
+    nkept = 0
+    while nkept < nsamples:
+        n_add = nsamples - nkept
+        s = np.asarray(draw_sample(nsamples))
+        s = s[in_sample(s)][:n_add]
+        samples[nkept:nkept + len(s)] = s
+        nkept += len(s)
         nsampled += nsamples
         if sample_constraint_rate:
             min_samples = nsampled * sample_constraint_rate
-            if min_samples > 1 and len(samples) < min_samples:
-                raise f"Failed to obtain at least one sample per {int(1/sample_constraint_rate)} trials"
+            if min_samples > 1 and nkept < min_samples:
+                raise RuntimeError("Failed to obtain at least one sample per "
+                                   f"{int(1/sample_constraint_rate)} trials")
     if not unsorted:
-        return sorted(samples)[::oversample]
+        samples.sort()
+        return samples[::oversample]
     else:
         if oversample == 1:
             return samples
-        sel_mask = np.zeros(len(samples), np.bool)
-        sorted_idx = np.argsort(samples)
-        sel_mask[sorted_idx[::oversample]] = True
-        return samples[sel_mask]
+        # every n-th value in sorted order, kept in the order they were drawn
+        sel_idx = np.argsort(samples)[::oversample]
+        sel_idx.sort()
+        return samples[sel_idx]
 
 def make_sample_bounded(lb, ub, draw_sample, nsamples, oversample=1, **kwargs):
     """Draw a number of samples from a distribution with enforced lower and upper bound.
@@ -126,25 +140,84 @@ def make_sample_bounded(lb, ub, draw_sample, nsamples, oversample=1, **kwargs):
         numpy array of sample values
     """
     def in_range(x):
-        return x >= lb and x <= ub
+        return (x >= lb) & (x <= ub)
     return make_sample_constrained(in_range, draw_sample,
                                    nsamples, oversample, **kwargs)
 
-def make_normal_bounded(lb, ub, nsamples, oversample=1, mu=None, sigma=None, **kwargs):
-    """Draw a number of samples from a normal distribution with enforced lower and upper bound."""
+def _cdf_range(distribution, lb, ub):
+    """CDF values of `distribution` at the bounds lb and ub"""
+    p_lb, p_ub = distribution.cdf(lb), distribution.cdf(ub)
+    if not p_lb < p_ub:
+        raise ValueError(f"Distribution has no probability mass in range [{lb}, {ub}]")
+    return p_lb, p_ub
+
+def sample_truncated(distribution, lb, ub, nsamples, unsorted=False):
+    """Draw samples from a distribution restricted to the range [lb, ub] via inverse transform
+    sampling, without rejecting any draws.
+    Args:
+        distribution - frozen scipy.stats distribution, providing cdf and ppf
+        lb, ub - lower and upper bound of range
+        nsamples - number of sample values to generate
+        unsorted - if True, return the sample values unsorted
+    Returns:
+        numpy array of sample values
+    """
+    p_lb, p_ub = _cdf_range(distribution, lb, ub)
+    s = distribution.ppf(_rng.uniform(p_lb, p_ub, nsamples))
+    return s if unsorted else np.sort(s)
+
+def quantiles_truncated(distribution, lb, ub, nsamples):
+    """Values at `nsamples` equally spaced quantiles of a distribution restricted to the
+    range [lb, ub]. This is the deterministic limit of drawing an oversampled set of values,
+    sorting it and keeping every n-th value, see make_sample_constrained.
+    Args:
+        distribution - frozen scipy.stats distribution, providing cdf and ppf
+        lb, ub - lower and upper bound of range
+        nsamples - number of values to generate
+    Returns:
+        sorted numpy array of values
+    """
+    p_lb, p_ub = _cdf_range(distribution, lb, ub)
+    return distribution.ppf(p_lb + (p_ub - p_lb) * (np.arange(nsamples) + .5) / nsamples)
+
+def make_normal_bounded(lb, ub, nsamples, oversample=1, mu=None, sigma=None,
+                        quantiles=False, **kwargs):
+    """Draw a number of samples from a normal distribution with enforced lower and upper bound.
+    Without oversampling, the truncated normal distribution is sampled directly.
+    If `quantiles` is True, return the deterministic values of quantiles_truncated instead
+    of random samples."""
     if mu is None:
         mu = lb + 0.5 * (ub - lb)
     if sigma is None:
-        sigma = lu_range * .5
-    draw_sample = lambda nsamples: np.random.normal(mu, sigma, nsamples)
+        sigma = (ub - lb) * .5
+    if quantiles:
+        distribution = _truncnorm((lb - mu) / sigma, (ub - mu) / sigma, loc=mu, scale=sigma)
+        return quantiles_truncated(distribution, lb, ub, nsamples)
+    if oversample == 1:
+        s = _truncnorm.rvs((lb - mu) / sigma, (ub - mu) / sigma, loc=mu, scale=sigma, size=nsamples,
+                           random_state=_rng)
+        return s if kwargs.get('unsorted') else np.sort(s)
+    draw_sample = lambda nsamples: _rng.normal(mu, sigma, nsamples)
     return make_sample_bounded(lb, ub, draw_sample, nsamples, oversample, **kwargs)
 
-def make_exponential_bounded(lb, ub, nsamples, oversample=1, scale=1.0, **kwargs):
-    """Draw a number of samples from an exponential distribution with enforced lower and upper bound."""
-    draw_sample = lambda nsamples: np.random.exponential(scale=scale, size=nsamples)
+def make_exponential_bounded(lb, ub, nsamples, oversample=1, scale=1.0, quantiles=False, **kwargs):
+    """Draw a number of samples from an exponential distribution with enforced lower and upper bound.
+    Without oversampling, the samples are drawn via sample_truncated.
+    If `quantiles` is True, return the deterministic values of quantiles_truncated instead."""
+    if quantiles:
+        return quantiles_truncated(_expon(scale=scale), lb, ub, nsamples)
+    if oversample == 1:
+        return sample_truncated(_expon(scale=scale), lb, ub, nsamples, kwargs.get('unsorted', False))
+    draw_sample = lambda nsamples: _rng.exponential(scale=scale, size=nsamples)
     return make_sample_bounded(lb, ub, draw_sample, nsamples, oversample, **kwargs)
 
-def make_power_bounded(lb, ub, nsamples, oversample=1, a=1.0, **kwargs):
-    """Draw a number of samples from a power distribution with enforced lower and upper bound."""
-    draw_sample = lambda nsamples: np.random.power(a=a, size=nsamples)
+def make_power_bounded(lb, ub, nsamples, oversample=1, a=1.0, quantiles=False, **kwargs):
+    """Draw a number of samples from a power distribution with enforced lower and upper bound.
+    Without oversampling, the samples are drawn via sample_truncated.
+    If `quantiles` is True, return the deterministic values of quantiles_truncated instead."""
+    if quantiles:
+        return quantiles_truncated(_powerlaw(a), lb, ub, nsamples)
+    if oversample == 1:
+        return sample_truncated(_powerlaw(a), lb, ub, nsamples, kwargs.get('unsorted', False))
+    draw_sample = lambda nsamples: _rng.power(a=a, size=nsamples)
     return make_sample_bounded(lb, ub, draw_sample, nsamples, oversample, **kwargs)
@@ -4,7 +4,10 @@ import os
 import subprocess
 import sys
 import importlib
+import numbers
 import uuid
+import hashlib
+import threading
 
 # ----------------------------------------------------------------------------
 # file path management
@@ -13,10 +16,7 @@ import uuid
 def eval_shell(cmdargs):
     """ Run command in shell and return string output.
         Input `cmdargs` is list of command and individual args."""
-    return (subprocess.
-            Popen(cmdargs,
-                  stdout=subprocess.PIPE)
-            .communicate()[0]
+    return (subprocess.run(cmdargs, stdout=subprocess.PIPE).stdout
             .rstrip()
             .decode('utf-8')
             )
@@ -60,8 +60,9 @@ def gdown_bytes(id, quiet=True):
     return buf
 
 def gdown_str(id, quiet=True, encoding='utf-8'):
-    """Download a publicly shared file on google drive into string object. """    
-    return gdown_bytes(id, quiet).read().decode(encoding)
+    """Download a publicly shared file on google drive into string object. """
+    # decode from the download buffer directly, without an intermediate bytes copy
+    return str(gdown_bytes(id, quiet).getbuffer(), encoding)
 
 # ----------------------------------------------------------------------------
 
@@ -73,8 +74,8 @@ def extend_range(min_max, extend_ratio=.2):
     return (min_max[0] - mme, min_max[1] + mme)
 
 def isnumber(n):
-    import numbers
-    return isinstance(n, numbers.Number)
+    # check the common concrete types before the slower abstract base class
+    return isinstance(n, (int, float)) or isinstance(n, numbers.Number)
 
 def isiterable(obj):
     """Check if object `obj` is iterable."""
@@ -101,23 +102,55 @@ def ensure_list(items, item_type=str):
     else:
         return items
 
+# ----------------------------------------------------------------------------
+# caches keyed by dataframe content, kept as OrderedDict in least recently used order
+
+__cache_lock = threading.Lock() # caches are shared with worker threads
+
+def dataframe_key(df):
+    """Content hash of dataframe `df` or None, if it can not be hashed."""
+    import pandas as pd
+    if not isinstance(df, pd.DataFrame):
+        return None
+    try:
+        h = hashlib.blake2b(pd.util.hash_pandas_object(df, index=True).values.tobytes(),
+                            digest_size=16)
+    except TypeError: # unhashable cell content, e.g. lists
+        return None
+    h.update(repr((df.shape, tuple(df.columns), tuple(map(str, df.dtypes)),
+                   tuple(df.index.names), tuple(df.columns.names))).encode())
+    return h.digest()
+
+def cache_get(cache, key):
+    """Value stored under `key` in OrderedDict `cache` or None, marking it as most recently used."""
+    if key is None:
+        return None
+    with __cache_lock:
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        return cache[key]
+
+def cache_put(cache, key, value, maxsize):
+    """Store `value` under `key` in OrderedDict `cache`, keeping at most `maxsize` entries."""
+    if key is None:
+        return
+    with __cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > maxsize:
+            cache.popitem(last=False)
+
 # ----------------------------------------------------------------------------
 # module reloading
 
 def reload_all(module_name):
     """Reload all modules that have `module_name` in their path."""
-    def num_dots(st):
-        return sum(l=='.' for l in st[0])
-    def get_modules():
-        for mn, mo in sys.modules.items():
-            try:
-                if mn[:2] == '__':
-                    continue
-                if module_name in mo.__file__:
-                    yield mn, mo
-            except:
-                pass
-    for mn, mo in sorted(get_modules(), key=num_dots, reverse=True):
+    matches = [(mn, mo) for mn, mo in list(sys.modules.items())
+               if mn[:2] != '__' and module_name in (getattr(mo, '__file__', None) or '')]
+    # reload submodules before the packages that contain them
+    matches.sort(key=lambda m: m[0].count('.'), reverse=True)
+    for mn, mo in matches:
         #print('import {}'.format(mn))
         importlib.reload(mo)
 